@@ -0,0 +1,6 @@
+-- Binary storage for face embeddings
+
+-- vector_bin: raw little-endian float32 bytes (128 dims = 512 bytes)
+-- The JSON vector column is kept nullable for legacy rows written before this change
+ALTER TABLE embeddings ADD COLUMN vector_bin VARBINARY(512) NULL AFTER vector;
+ALTER TABLE embeddings MODIFY vector JSON NULL;
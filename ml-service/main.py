@@ -1,18 +1,32 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import face_recognition
+from face_recognition.api import _raw_face_landmarks, face_encoder
+import dlib
+import faiss
+from numba import njit, prange
 import cv2
 import numpy as np
 from PIL import Image
 import io
 import os
-import json
-from typing import List, Optional, Dict, Any
+import asyncio
+import threading
+import struct
+import fcntl
+from contextlib import contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import hashlib
+from collections import OrderedDict
+import orjson
+from typing import List, Optional, Dict, Any, Tuple, NamedTuple, Set
 import logging
 from sqlalchemy import create_engine, text
 from minio import Minio
-import requests
+import httpx
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -51,7 +65,16 @@ MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minioadmin")
 
 # Initialize database connection
 DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-engine = create_engine(DATABASE_URL)
+# Per worker process: with ML_WORKERS workers the service can open up to
+# ML_WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections, and MariaDB's
+# default max_connections is 151
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+    pool_pre_ping=True,
+    pool_recycle=1800
+)
 
 # Initialize MinIO client
 minio_client = Minio(
@@ -84,57 +107,517 @@ class EmbeddingResponse(BaseModel):
     embedding_id: Optional[int] = None
     message: str
 
+class BatchEmbeddingResponse(BaseModel):
+    success: bool
+    created: int
+    failed_student_ids: List[str] = []
+    message: str
+
 # Global variables for caching
-known_encodings = {}
-known_student_ids = []
+# Encodings are kept as one contiguous (N, 128) float32 matrix with a parallel
+# list of student IDs so matching can be done in a single vectorized pass.
+# The whole cache is an immutable snapshot: writers build a new EncodingCache
+# under cache_lock and publish it with a single assignment, readers take
+# cache_state once and use only that snapshot.
+ENCODING_DIM = 128
+
+# Approximate nearest-neighbour index, used once enrollment reaches
+# ANN_MIN_EMBEDDINGS
+ANN_MIN_EMBEDDINGS = int(os.getenv("ANN_MIN_EMBEDDINGS", "5000"))
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+# Candidates explored per query; faiss's default of 16 loses recall on 1-NN matches
+ANN_HNSW_EF_SEARCH = int(os.getenv("ANN_HNSW_EF_SEARCH", "64"))
+
+class EncodingCache(NamedTuple):
+    matrix: np.ndarray
+    norms_sq: np.ndarray  # squared row norms of matrix
+    ids: Tuple[str, ...]
+    ann_index: Optional[Any] = None  # built from this exact matrix, if any
+    version: int = 0  # shared-memory segment version, 0 when not shared
+
+EMPTY_CACHE = EncodingCache(
+    matrix=np.empty((0, ENCODING_DIM), dtype=np.float32),
+    norms_sq=np.empty(0, dtype=np.float32),
+    ids=()
+)
+
+cache_state = EMPTY_CACHE
+cache_lock = threading.Lock()
+
+# With several uvicorn workers (ML_WORKERS > 1) the cache lives in POSIX shared
+# memory, so every worker maps one copy of the matrix instead of holding its own.
+# Each published cache is a new segment "<prefix>_<version>"; a small control
+# segment holds the current version and the PID of the uvicorn master that
+# wrote it. Writers across workers are serialized with an flock on
+# SHM_LOCK_PATH, readers compare versions and rebind when it changes.
+ML_WORKERS = int(os.getenv("ML_WORKERS", "1"))
+SHARED_CACHE = ML_WORKERS > 1
+SHM_PREFIX = os.getenv("SHM_PREFIX", "labface_cache")
+SHM_LOCK_PATH = os.getenv("SHM_LOCK_PATH", f"/tmp/{SHM_PREFIX}.lock")
+SEGMENT_HEADER = struct.Struct("qq")  # row count, length of the JSON id list
+
+control_segment: Optional[SharedMemory] = None
+# Segments this worker has mapped, kept until no snapshot uses them
+attached_segments: Dict[int, SharedMemory] = {}
+
+def untrack_segment(shm: SharedMemory):
+    """Stop the resource tracker from unlinking a segment when this worker exits"""
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+def segment_name(version: int) -> str:
+    return f"{SHM_PREFIX}_{version}"
+
+def open_control_segment():
+    """Create or attach the control segment holding (version, master PID)"""
+    global control_segment
+    
+    try:
+        control_segment = SharedMemory(name=f"{SHM_PREFIX}_ctl", create=True, size=16)
+    except FileExistsError:
+        control_segment = SharedMemory(name=f"{SHM_PREFIX}_ctl")
+    untrack_segment(control_segment)
+
+def read_shared_version() -> int:
+    """Current shared cache version, or 0 if none was written by this server"""
+    version, master_pid = struct.unpack_from("qq", control_segment.buf, 0)
+    # A segment left over from a previous server run is treated as absent
+    return version if master_pid == os.getppid() else 0
+
+def write_segment(version: int, state: EncodingCache) -> SharedMemory:
+    """Copy a cache snapshot into a new shared-memory segment"""
+    ids_json = orjson.dumps(list(state.ids))
+    matrix_bytes = state.matrix.nbytes
+    size = SEGMENT_HEADER.size + matrix_bytes + state.norms_sq.nbytes + len(ids_json)
+    
+    try:
+        shm = SharedMemory(name=segment_name(version), create=True, size=size)
+    except FileExistsError:
+        # Left over from a previous server run
+        unlink_segment(version)
+        shm = SharedMemory(name=segment_name(version), create=True, size=size)
+    untrack_segment(shm)
+    
+    offset = SEGMENT_HEADER.size
+    SEGMENT_HEADER.pack_into(shm.buf, 0, len(state.ids), len(ids_json))
+    shm.buf[offset:offset + matrix_bytes] = state.matrix.astype(np.float32, copy=False).tobytes()
+    offset += matrix_bytes
+    shm.buf[offset:offset + state.norms_sq.nbytes] = state.norms_sq.astype(np.float32, copy=False).tobytes()
+    offset += state.norms_sq.nbytes
+    shm.buf[offset:offset + len(ids_json)] = ids_json
+    
+    return shm
+
+def view_segment(version: int, shm: SharedMemory) -> EncodingCache:
+    """Build a cache snapshot whose arrays point straight into a segment"""
+    count, ids_length = SEGMENT_HEADER.unpack_from(shm.buf, 0)
+    
+    # np.frombuffer keeps a buffer export on the mapping, so shm.close() raises
+    # BufferError while any view is alive; np.ndarray(buffer=...) does not
+    offset = SEGMENT_HEADER.size
+    matrix = np.frombuffer(shm.buf, dtype=np.float32, count=count * ENCODING_DIM, offset=offset)
+    matrix = matrix.reshape(count, ENCODING_DIM)
+    offset += matrix.nbytes
+    norms_sq = np.frombuffer(shm.buf, dtype=np.float32, count=count, offset=offset)
+    offset += norms_sq.nbytes
+    ids = tuple(orjson.loads(bytes(shm.buf[offset:offset + ids_length])))
+    
+    return EncodingCache(matrix, norms_sq, ids, version=version)
+
+def unlink_segment(version: int):
+    """Remove a superseded segment; workers that still map it keep their view"""
+    try:
+        shm = SharedMemory(name=segment_name(version))
+    except FileNotFoundError:
+        return
+    shm.unlink()
+    shm.close()
+
+def release_stale_segments():
+    """Unmap segments no longer referenced by any snapshot in this worker"""
+    for version, shm in list(attached_segments.items()):
+        if version == cache_state.version:
+            continue
+        try:
+            shm.close()
+        except BufferError:
+            continue  # an in-flight request still holds its arrays
+        del attached_segments[version]
+
+def rebind_shared_cache() -> bool:
+    """Point cache_state at the latest shared segment; caller holds cache_lock"""
+    global cache_state
+    
+    version = read_shared_version()
+    if version == 0 or version == cache_state.version:
+        return False
+    
+    if version not in attached_segments:
+        try:
+            shm = SharedMemory(name=segment_name(version))
+        except FileNotFoundError:
+            return False  # already superseded, the next check picks up the newer one
+        untrack_segment(shm)
+        attached_segments[version] = shm
+    
+    previous = cache_state
+    cache_state = view_segment(version, attached_segments[version])
+    
+    # Pure append since our last snapshot: extend a copy of the local index
+    # instead of rebuilding it. Replaced or deleted rows need the full rebuild.
+    count = len(previous.ids)
+    if (
+        previous.ann_index is not None
+        and cache_state.ids[:count] == previous.ids
+        and np.array_equal(cache_state.matrix[:count], previous.matrix)
+    ):
+        ann_index = faiss.clone_index(previous.ann_index)
+        ann_index.add(cache_state.matrix[count:])
+        cache_state = cache_state._replace(ann_index=ann_index)
+    
+    del previous  # drop its views so the old segment can be unmapped
+    release_stale_segments()
+    return True
+
+def sync_shared_cache() -> bool:
+    """Pick up a cache published by another worker, returning True if it changed"""
+    if not SHARED_CACHE or read_shared_version() == cache_state.version:
+        return False
+    # Called on the request path: if a writer holds the lock (possibly across
+    # a DB reload), keep serving the current snapshot and rebind next time
+    if not cache_lock.acquire(blocking=False):
+        return False
+    try:
+        return rebind_shared_cache()
+    finally:
+        cache_lock.release()
+
+@contextmanager
+def cache_write_lock():
+    """Serialize cache writers in this worker and, when shared, across workers"""
+    with cache_lock:
+        if not SHARED_CACHE:
+            yield
+            return
+        
+        with open(SHM_LOCK_PATH, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Build on top of whatever another worker published last
+                rebind_shared_cache()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def publish_cache(state: EncodingCache):
+    """Make a new snapshot current; caller holds cache_write_lock"""
+    global cache_state
+    
+    if not SHARED_CACHE:
+        cache_state = state
+        return
+    
+    previous_version = read_shared_version()
+    version = max(previous_version, cache_state.version) + 1
+    
+    shm = write_segment(version, state)
+    attached_segments[version] = shm
+    struct.pack_into("qq", control_segment.buf, 0, version, os.getppid())
+    cache_state = view_segment(version, shm)._replace(ann_index=state.ann_index)
+    
+    if previous_version:
+        unlink_segment(previous_version)
+    release_stale_segments()
+
+def encode_vector(encoding: np.ndarray) -> bytes:
+    """Serialize a face encoding to raw float32 bytes for storage"""
+    return np.asarray(encoding, dtype=np.float32).tobytes()
+
+def decode_vector(vector_bin: Optional[bytes], vector_json: Optional[str] = None) -> np.ndarray:
+    """Deserialize a stored face encoding, falling back to legacy JSON rows"""
+    if vector_bin is not None:
+        return np.frombuffer(vector_bin, dtype=np.float32)
+    return np.asarray(orjson.loads(vector_json), dtype=np.float32)
+
+def row_norms_sq(matrix: np.ndarray) -> np.ndarray:
+    """Squared L2 norm of every row"""
+    return np.einsum('ij,ij->i', matrix, matrix)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def nearest_l2(matrix: np.ndarray, norms_sq: np.ndarray, query: np.ndarray) -> Tuple[int, float]:
+    """Index and score of the row closest to query, score being ||a||^2 - 2 a.q"""
+    n = matrix.shape[0]
+    scores = np.empty(n, dtype=np.float32)
+    
+    for i in prange(n):
+        dot = np.float32(0.0)
+        for k in range(matrix.shape[1]):
+            dot += matrix[i, k] * query[k]
+        scores[i] = norms_sq[i] - 2.0 * dot
+    
+    best = 0
+    for i in range(1, n):
+        if scores[i] < scores[best]:
+            best = i
+    return best, scores[best]
 
 def load_embeddings_from_db():
     """Load all embeddings from database"""
-    global known_encodings, known_student_ids
-    
     try:
-        with engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT student_id, vector, model_name 
-                FROM embeddings 
-                WHERE model_name = 'face_recognition'
-            """))
+        # Hold the write lock across the SELECT and the publish, so an
+        # enrollment cannot land in between and be overwritten by this snapshot
+        with cache_write_lock():
+            with engine.connect() as conn:
+                result = conn.execute(text("""
+                    SELECT student_id, vector, vector_bin, model_name 
+                    FROM embeddings 
+                    WHERE model_name = 'face_recognition'
+                """))
+                
+                # Later rows win, matching the one-encoding-per-student cache
+                encodings: Dict[str, np.ndarray] = {}
+                
+                for row in result:
+                    student_id = row[0]
+                    encodings[student_id] = decode_vector(row[2], row[1])
             
-            known_encodings = {}
-            known_student_ids = []
+            if encodings:
+                matrix = np.ascontiguousarray(np.stack(list(encodings.values())), dtype=np.float32)
+                state = EncodingCache(matrix, row_norms_sq(matrix), tuple(encodings.keys()))
+            else:
+                state = EMPTY_CACHE
             
-            for row in result:
-                student_id = row[0]
-                vector_data = json.loads(row[1])
-                model_name = row[2]
-                
-                # Convert back to numpy array
-                encoding = np.array(vector_data)
-                known_encodings[student_id] = encoding
-                known_student_ids.append(student_id)
+            publish_cache(state)
                 
-        logger.info(f"Loaded {len(known_encodings)} embeddings from database")
+        logger.info(f"Loaded {len(state.ids)} embeddings from database")
         
     except Exception as e:
+        # Keep the current snapshot: publishing an empty one would wipe the
+        # cache in every worker over a transient error
         logger.error(f"Error loading embeddings: {e}")
-        known_encodings = {}
-        known_student_ids = []
+        raise
+    
+    # The load already succeeded; without an index /match uses the exact scan
+    try:
+        refresh_ann_index()
+    except Exception as e:
+        logger.error(f"Error building ANN index: {e}")
+
+def init_cache():
+    """Populate the cache on startup, reusing another worker's shared copy if present"""
+    if SHARED_CACHE:
+        open_control_segment()
+        if sync_shared_cache():
+            try:
+                refresh_ann_index()
+            except Exception as e:
+                logger.error(f"Error building ANN index: {e}")
+            logger.info(f"Attached shared cache with {len(cache_state.ids)} embeddings")
+            return
+    
+    try:
+        load_embeddings_from_db()
+    except Exception:
+        # Start with an empty cache; /reload-embeddings can retry later
+        pass
+
+def cache_add_encodings(student_ids: List[str], encodings: List[np.ndarray]):
+    """Insert or replace several students' encodings with a single matrix rebuild"""
+    # Later duplicates win, as with sequential inserts
+    updates = dict(zip(student_ids, np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)))
+    
+    with cache_write_lock():
+        current = cache_state
+        positions = {student_id: idx for idx, student_id in enumerate(current.ids)}
+        
+        # Never mutate the published arrays, readers may be using them
+        matrix = current.matrix.copy()
+        norms = current.norms_sq.copy()
+        ids = list(current.ids)
+        appended = []
+        replaced = False
+        
+        for student_id, row in updates.items():
+            if student_id in positions:
+                idx = positions[student_id]
+                matrix[idx] = row
+                norms[idx] = row @ row
+                replaced = True
+            else:
+                appended.append(row)
+                ids.append(student_id)
+        
+        # Pure appends extend a copy of the current ANN index; a replaced row
+        # invalidates it and the caller schedules a rebuild
+        ann_index = None if replaced else current.ann_index
+        
+        if appended:
+            new_rows = np.stack(appended)
+            matrix = np.ascontiguousarray(np.vstack([matrix, new_rows]))
+            norms = np.concatenate([norms, row_norms_sq(new_rows)])
+            if ann_index is not None:
+                # Copy so searches on the published index never race the add
+                ann_index = faiss.clone_index(ann_index)
+                ann_index.add(new_rows)
+        
+        publish_cache(EncodingCache(matrix, norms, tuple(ids), ann_index=ann_index))
+
+def cache_add_encoding(student_id: str, encoding: np.ndarray):
+    """Insert or replace a student's encoding in the cached matrix"""
+    cache_add_encodings([student_id], [encoding])
+
+def cache_remove_encoding(student_id: str):
+    """Drop a student's encoding from the cached matrix"""
+    with cache_write_lock():
+        current = cache_state
+        if student_id not in current.ids:
+            return
+        
+        idx = current.ids.index(student_id)
+        publish_cache(EncodingCache(
+            np.delete(current.matrix, idx, axis=0),
+            np.delete(current.norms_sq, idx),
+            current.ids[:idx] + current.ids[idx + 1:]
+        ))
+
+def build_ann_index(matrix: np.ndarray) -> Any:
+    """Build an HNSW index over the given rows"""
+    # Vectors are stored as FP16 inside the index, halving its memory traffic;
+    # dlib encodings lose well under 1e-3 in distance at this precision
+    index = faiss.IndexHNSWSQ(ENCODING_DIM, faiss.ScalarQuantizer.QT_fp16, ANN_HNSW_M)
+    index.hnsw.efSearch = ANN_HNSW_EF_SEARCH
+    index.train(matrix)
+    index.add(matrix)
+    return index
+
+def refresh_ann_index():
+    """Build an ANN index for the current cache snapshot if it needs one"""
+    global cache_state
+    
+    state = cache_state
+    if len(state.ids) < ANN_MIN_EMBEDDINGS or state.ann_index is not None:
+        return
+    
+    # Build outside the lock so enrollment and matching are not blocked
+    index = build_ann_index(state.matrix)
+    
+    with cache_lock:
+        # Only publish if no writer replaced the snapshot in the meantime
+        if cache_state.matrix is state.matrix:
+            cache_state = state._replace(ann_index=index)
+            logger.info(f"Built ANN index over {len(state.ids)} embeddings")
+
+# Background ANN rebuilds; /match uses the exact scan until the index is attached
+ann_refresh_task: Optional[asyncio.Task] = None
+ann_refresh_pending = False
+
+async def ann_refresh_loop():
+    """Rebuild the ANN index until no refresh was requested during the last build"""
+    global ann_refresh_pending
+    
+    while ann_refresh_pending:
+        ann_refresh_pending = False
+        try:
+            await run_in_threadpool(refresh_ann_index)
+        except Exception as e:
+            logger.error(f"Error building ANN index: {e}")
+
+def schedule_ann_refresh():
+    """Request an ANN rebuild without blocking the caller"""
+    global ann_refresh_task, ann_refresh_pending
+    
+    ann_refresh_pending = True
+    if ann_refresh_task is None or ann_refresh_task.done():
+        ann_refresh_task = asyncio.create_task(ann_refresh_loop())
+
+async def ensure_cache_current():
+    """Rebind to another worker's latest cache and rebuild its ANN index in the background"""
+    if not SHARED_CACHE or read_shared_version() == cache_state.version:
+        return
+    # Extending the index copies it, so rebind off the event loop
+    if await run_in_threadpool(sync_shared_cache):
+        schedule_ann_refresh()
+
+# Large uploads are decoded at 1/2 or 1/4 scale, never below this many pixels
+# on the longer side. The HOG detector works fine at this resolution.
+DECODE_MIN_SIDE = int(os.getenv("DECODE_MIN_SIDE", "800"))
+
+def get_decode_flag(image_data: bytes) -> int:
+    """Pick a cv2 decode mode that shrinks oversized images while decoding"""
+    try:
+        # PIL only parses the header here, the pixels are not decoded
+        longest_side = max(Image.open(io.BytesIO(image_data)).size)
+    except Exception:
+        return cv2.IMREAD_COLOR
+    
+    if longest_side >= DECODE_MIN_SIDE * 4:
+        return cv2.IMREAD_REDUCED_COLOR_4
+    if longest_side >= DECODE_MIN_SIDE * 2:
+        return cv2.IMREAD_REDUCED_COLOR_2
+    return cv2.IMREAD_COLOR
+
+def sniff_image_format(image_data: bytes) -> Optional[str]:
+    """Identify a supported image format from its magic bytes"""
+    if image_data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if image_data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def decode_image(image_data: bytes) -> Optional[np.ndarray]:
+    """Decode image bytes into an RGB array"""
+    # Convert bytes to numpy array
+    nparr = np.frombuffer(image_data, np.uint8)
+    image = cv2.imdecode(nparr, get_decode_flag(image_data))
+    
+    if image is None:
+        return None
+        
+    # Convert BGR to RGB. dlib needs a C-contiguous array, so a strided
+    # image[:, :, ::-1] view would be copied anyway; cvtColor does it in one pass
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+# With a CUDA build of dlib, detection uses the CNN model (loaded once by
+# face_recognition at import) and runs batched on the GPU; otherwise HOG on CPU
+USE_GPU = bool(getattr(dlib, "DLIB_USE_CUDA", False))
+DETECTION_MODEL = "cnn" if USE_GPU else "hog"
+
+def detect_faces_batch(rgb_images: List[Optional[np.ndarray]]) -> List[List[Tuple[int, int, int, int]]]:
+    """Face locations for each image; undecodable images get none"""
+    face_locations: List[List[Tuple[int, int, int, int]]] = [[] for _ in rgb_images]
+    
+    if not USE_GPU:
+        for i, rgb_image in enumerate(rgb_images):
+            if rgb_image is not None:
+                face_locations[i] = face_recognition.face_locations(rgb_image)
+        return face_locations
+    
+    # The CNN batch call needs equally sized images, so batch per shape
+    groups: Dict[Tuple[int, ...], List[int]] = {}
+    for i, rgb_image in enumerate(rgb_images):
+        if rgb_image is not None:
+            groups.setdefault(rgb_image.shape, []).append(i)
+    
+    for indices in groups.values():
+        batch_locations = face_recognition.batch_face_locations(
+            [rgb_images[i] for i in indices], batch_size=len(indices)
+        )
+        for i, locations in zip(indices, batch_locations):
+            face_locations[i] = locations
+    
+    return face_locations
 
 def get_face_encoding(image_data: bytes) -> Optional[np.ndarray]:
     """Extract face encoding from image data"""
     try:
-        # Convert bytes to numpy array
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        rgb_image = decode_image(image_data)
         
-        if image is None:
+        if rgb_image is None:
             return None
-            
-        # Convert BGR to RGB
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
         # Find face locations
-        face_locations = face_recognition.face_locations(rgb_image)
+        face_locations = face_recognition.face_locations(rgb_image, model=DETECTION_MODEL)
         
         if not face_locations:
             return None
@@ -151,12 +634,206 @@ def get_face_encoding(image_data: bytes) -> Optional[np.ndarray]:
         logger.error(f"Error extracting face encoding: {e}")
         return None
 
-def download_image_from_url(url: str) -> Optional[bytes]:
+def get_face_encodings_batch(images: List[bytes]) -> List[Optional[np.ndarray]]:
+    """Extract the first face encoding of each image, encoding all faces in one dlib call"""
+    try:
+        rgb_images = [decode_image(image_data) for image_data in images]
+        face_locations = detect_faces_batch(rgb_images)
+        
+        # Only the first face of each image is used, as in get_face_encoding
+        pending = [i for i, locations in enumerate(face_locations) if locations]
+        encodings: List[Optional[np.ndarray]] = [None] * len(images)
+        
+        if not pending:
+            return encodings
+        
+        batch_faces = []
+        for i in pending:
+            faces = dlib.full_object_detections()
+            faces.append(_raw_face_landmarks(rgb_images[i], face_locations[i][:1], model="small")[0])
+            batch_faces.append(faces)
+        
+        descriptors = face_encoder.compute_face_descriptor(
+            [rgb_images[i] for i in pending], batch_faces, 1
+        )
+        
+        for i, image_descriptors in zip(pending, descriptors):
+            encodings[i] = np.array(image_descriptors[0])
+        
+        return encodings
+        
+    except Exception as e:
+        logger.error(f"Error extracting batched face encodings: {e}")
+        return [get_face_encoding(image_data) for image_data in images]
+
+# Micro-batching for /match: requests arriving within MATCH_MAX_LATENCY_MS of
+# each other are encoded together, up to MATCH_MAX_BATCH at a time. Up to
+# MATCH_MAX_CONCURRENT_BATCHES batches run in the threadpool at once, and the
+# queue holds at most MATCH_QUEUE_SIZE waiting images so bursts push back on
+# callers instead of growing without bound
+MATCH_MAX_BATCH = int(os.getenv("MATCH_MAX_BATCH", "16"))
+MATCH_MAX_LATENCY = float(os.getenv("MATCH_MAX_LATENCY_MS", "10")) / 1000
+MATCH_MAX_CONCURRENT_BATCHES = int(os.getenv("MATCH_MAX_CONCURRENT_BATCHES", "4"))
+MATCH_QUEUE_SIZE = int(os.getenv("MATCH_QUEUE_SIZE", "256"))
+
+encode_queue: Optional[asyncio.Queue] = None
+encode_worker: Optional[asyncio.Task] = None
+encode_batch_tasks: Set[asyncio.Task] = set()
+
+async def run_encode_batch(items: List[Tuple[bytes, asyncio.Future]], slots: asyncio.Semaphore):
+    """Encode one collected batch and resolve each caller's future"""
+    try:
+        try:
+            encodings = await run_in_threadpool(
+                get_face_encodings_batch, [image_data for image_data, _ in items]
+            )
+        except Exception as e:
+            logger.error(f"Error in encode batch worker: {e}")
+            encodings = [None] * len(items)
+        
+        for (_, future), encoding in zip(items, encodings):
+            if not future.done():
+                future.set_result(encoding)
+    finally:
+        slots.release()
+
+async def encode_batch_worker():
+    """Drain the encode queue in batches, dispatching each batch as its own task"""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(MATCH_MAX_CONCURRENT_BATCHES)
+    
+    try:
+        while True:
+            # Wait for a free slot first, so a saturated threadpool leaves
+            # requests in the bounded queue rather than in pending tasks
+            await slots.acquire()
+            try:
+                items = [await encode_queue.get()]
+            except BaseException:
+                slots.release()
+                raise
+            deadline = loop.time() + MATCH_MAX_LATENCY
+            
+            while len(items) < MATCH_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(encode_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            task = asyncio.create_task(run_encode_batch(items, slots))
+            encode_batch_tasks.add(task)
+            task.add_done_callback(encode_batch_tasks.discard)
+    finally:
+        for task in encode_batch_tasks:
+            task.cancel()
+
+async def submit_for_encoding(image_data: bytes) -> Optional[np.ndarray]:
+    """Queue an image for batched encoding and wait for its result"""
+    future = asyncio.get_running_loop().create_future()
+    await encode_queue.put((image_data, future))
+    return await future
+
+# Encodings of recently seen uploads, keyed by SHA-256 of the image bytes, so
+# retries and duplicate polls skip detection entirely. Only successful encodings
+# are cached: a None may come from a transient decode or dlib failure.
+ENCODING_CACHE_SIZE = int(os.getenv("ENCODING_CACHE_SIZE", "4096"))
+encoding_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+
+async def get_face_encoding_cached(image_data: bytes) -> Tuple[Optional[np.ndarray], bool]:
+    """Encode an image via the batch queue, returning (encoding, cache_hit)"""
+    digest = hashlib.sha256(image_data).digest()
+    
+    if digest in encoding_cache:
+        encoding_cache.move_to_end(digest)
+        return encoding_cache[digest], True
+    
+    encoding = await submit_for_encoding(image_data)
+    if encoding is None:
+        return None, False
+    
+    encoding.setflags(write=False)
+    encoding_cache[digest] = encoding
+    if len(encoding_cache) > ENCODING_CACHE_SIZE:
+        encoding_cache.popitem(last=False)
+    
+    return encoding, False
+
+def insert_embedding(student_id: str, model_name: str, encoding: np.ndarray) -> int:
+    """Insert a face encoding into the database and return its ID"""
+    with engine.begin() as conn:
+        result = conn.execute(text("""
+            INSERT INTO embeddings (student_id, model_name, vector_bin)
+            VALUES (:student_id, :model_name, :vector_bin)
+        """), {
+            'student_id': student_id,
+            'model_name': model_name,
+            'vector_bin': encode_vector(encoding)
+        })
+        
+        return result.lastrowid
+
+def insert_embeddings(rows: List[Dict[str, Any]]):
+    """Insert many face encodings in a single transaction"""
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO embeddings (student_id, model_name, vector_bin)
+            VALUES (:student_id, :model_name, :vector_bin)
+        """), rows)
+
+def delete_embeddings_from_db(student_id: str):
+    """Delete all stored encodings for a student"""
+    with engine.begin() as conn:
+        conn.execute(text("""
+            DELETE FROM embeddings 
+            WHERE student_id = :student_id
+        """), {'student_id': student_id})
+
+# Shared HTTP client, created on startup
+http_client: Optional[httpx.AsyncClient] = None
+
+def warm_up_models():
+    """Run detection and encoding once so dlib's models are loaded before the first request"""
+    try:
+        dummy = np.zeros((160, 160, 3), dtype=np.uint8)
+        face_recognition.face_locations(dummy, model=DETECTION_MODEL)
+        face_recognition.face_encodings(dummy, known_face_locations=[(0, 160, 160, 0)])
+        logger.info("Face recognition models warmed up")
+    except Exception as e:
+        logger.warning(f"Model warm-up failed: {e}")
+
+async def warm_up_http_client():
+    """Open a pooled connection to MinIO, where uploaded images are served from"""
+    try:
+        await http_client.get(f"http://{MINIO_ENDPOINT}/minio/health/live")
+    except Exception as e:
+        logger.warning(f"HTTP client warm-up failed: {e}")
+
+# Downloads larger than this are rejected
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+async def download_image_from_url(url: str) -> Optional[bytes]:
     """Download image from URL"""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        return response.content
+        async with http_client.stream("GET", url) as response:
+            response.raise_for_status()
+            
+            content_length = int(response.headers.get("content-length", 0))
+            if content_length > MAX_IMAGE_BYTES:
+                logger.error(f"Image at {url} is too large ({content_length} bytes)")
+                return None
+            
+            buffer = bytearray()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                if len(buffer) + len(chunk) > MAX_IMAGE_BYTES:
+                    logger.error(f"Image at {url} exceeds {MAX_IMAGE_BYTES} bytes")
+                    return None
+                buffer.extend(chunk)
+            
+            return bytes(buffer)
     except Exception as e:
         logger.error(f"Error downloading image from {url}: {e}")
         return None
@@ -164,8 +841,33 @@ def download_image_from_url(url: str) -> Optional[bytes]:
 @app.on_event("startup")
 async def startup_event():
     """Initialize service on startup"""
+    global http_client, encode_queue, encode_worker
+    
     logger.info("Starting LabFace ML Service...")
-    load_embeddings_from_db()
+    http_client = httpx.AsyncClient(timeout=10)
+    encode_queue = asyncio.Queue(maxsize=MATCH_QUEUE_SIZE)
+    encode_worker = asyncio.create_task(encode_batch_worker())
+    
+    # Compile the match kernel now rather than on the first /match request
+    nearest_l2(
+        np.zeros((1, ENCODING_DIM), dtype=np.float32),
+        np.zeros(1, dtype=np.float32),
+        np.zeros(ENCODING_DIM, dtype=np.float32)
+    )
+    await run_in_threadpool(init_cache)
+    await run_in_threadpool(warm_up_models)
+    await warm_up_http_client()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release resources on shutdown"""
+    if encode_worker is not None:
+        encode_worker.cancel()
+    if ann_refresh_task is not None:
+        ann_refresh_task.cancel()
+    if http_client is not None:
+        await http_client.aclose()
+    engine.dispose()
 
 @app.get("/health")
 async def health_check():
@@ -173,12 +875,12 @@ async def health_check():
     return {"status": "healthy", "service": "ml-service"}
 
 @app.post("/match", response_model=MatchResponse)
-async def match_face(request: MatchRequest):
+async def match_face(request: MatchRequest, response: Response):
     """Match a face against known embeddings"""
     try:
         # Get image data
         if request.image_url:
-            image_data = download_image_from_url(request.image_url)
+            image_data = await download_image_from_url(request.image_url)
             if not image_data:
                 raise HTTPException(status_code=400, detail="Could not download image")
         elif request.image_data:
@@ -187,8 +889,13 @@ async def match_face(request: MatchRequest):
         else:
             raise HTTPException(status_code=400, detail="Either image_url or image_data required")
         
+        # Reject non-images before any decode or detection work
+        if sniff_image_format(image_data) is None:
+            raise HTTPException(status_code=400, detail="Unsupported image format")
+        
         # Extract face encoding
-        face_encoding = get_face_encoding(image_data)
+        face_encoding, cache_hit = await get_face_encoding_cached(image_data)
+        response.headers["X-Cache"] = "HIT" if cache_hit else "MISS"
         if face_encoding is None:
             return MatchResponse(
                 matched=False,
@@ -196,25 +903,33 @@ async def match_face(request: MatchRequest):
             )
         
         # Compare with known encodings
-        if not known_encodings:
+        await ensure_cache_current()
+        state = cache_state
+        if not state.ids:
             return MatchResponse(
                 matched=False,
                 message="No known faces in database"
             )
         
-        # Calculate distances
-        distances = []
-        student_ids = []
+        query = face_encoding.astype(np.float32)
         
-        for student_id, known_encoding in known_encodings.items():
-            distance = face_recognition.face_distance([known_encoding], face_encoding)[0]
-            distances.append(distance)
-            student_ids.append(student_id)
+        best_match_idx = -1
+        if state.ann_index is not None:
+            # Large enrollment: approximate search over the HNSW index
+            distances, indices = state.ann_index.search(query.reshape(1, -1), 1)
+            best_match_idx = int(indices[0, 0])
+            squared_distance = float(distances[0, 0])
+        
+        # FAISS reports -1 when the graph walk finds no neighbour; use the exact scan
+        if best_match_idx < 0:
+            # ||a - q||^2 = ||a||^2 - 2 a.q + ||q||^2; the ||q||^2 term is constant
+            # across rows, so ranking only needs one fused dot-product pass
+            best_match_idx, score = nearest_l2(state.matrix, state.norms_sq, query)
+            squared_distance = float(score + query @ query)
         
         # Find best match
-        min_distance = min(distances)
-        best_match_idx = distances.index(min_distance)
-        best_student_id = student_ids[best_match_idx]
+        min_distance = float(np.sqrt(max(squared_distance, 0.0)))
+        best_student_id = state.ids[best_match_idx]
         
         # Confidence threshold (lower distance = higher confidence)
         confidence_threshold = 0.6
@@ -236,6 +951,8 @@ async def match_face(request: MatchRequest):
                 message="Face not recognized"
             )
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in face matching: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -245,35 +962,27 @@ async def create_embedding(request: EmbeddingRequest):
     """Create and store face embedding"""
     try:
         # Download image
-        image_data = download_image_from_url(request.image_url)
+        image_data = await download_image_from_url(request.image_url)
         if not image_data:
             raise HTTPException(status_code=400, detail="Could not download image")
         
+        # Reject non-images before any decode or detection work
+        if sniff_image_format(image_data) is None:
+            raise HTTPException(status_code=400, detail="Unsupported image format")
+        
         # Extract face encoding
-        face_encoding = get_face_encoding(image_data)
+        face_encoding = await run_in_threadpool(get_face_encoding, image_data)
         if face_encoding is None:
             raise HTTPException(status_code=400, detail="No face detected in image")
         
-        # Convert to JSON-serializable format
-        vector_data = face_encoding.tolist()
-        
         # Store in database
-        with engine.connect() as conn:
-            result = conn.execute(text("""
-                INSERT INTO embeddings (student_id, model_name, vector)
-                VALUES (:student_id, :model_name, :vector)
-            """), {
-                'student_id': request.student_id,
-                'model_name': request.model_name,
-                'vector': json.dumps(vector_data)
-            })
-            
-            embedding_id = result.lastrowid
-            
+        embedding_id = await run_in_threadpool(
+            insert_embedding, request.student_id, request.model_name, face_encoding
+        )
+        
         # Update cache
-        known_encodings[request.student_id] = face_encoding
-        if request.student_id not in known_student_ids:
-            known_student_ids.append(request.student_id)
+        await run_in_threadpool(cache_add_encoding, request.student_id, face_encoding)
+        schedule_ann_refresh()
         
         logger.info(f"Created embedding for student {request.student_id}")
         
@@ -283,25 +992,92 @@ async def create_embedding(request: EmbeddingRequest):
             message="Embedding created successfully"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error creating embedding: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Largest list accepted by /embeddings/batch
+MAX_BATCH_EMBEDDINGS = int(os.getenv("MAX_BATCH_EMBEDDINGS", "100"))
+
+@app.post("/embeddings/batch", response_model=BatchEmbeddingResponse)
+async def create_embeddings_batch(batch: List[EmbeddingRequest]):
+    """Create and store face embeddings for many students at once"""
+    try:
+        if len(batch) > MAX_BATCH_EMBEDDINGS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"At most {MAX_BATCH_EMBEDDINGS} embeddings per batch"
+            )
+        
+        # Download and encode in chunks so only one chunk of images is held in
+        # memory and in flight at a time
+        enrolled: List[Tuple[int, np.ndarray]] = []
+        for start in range(0, len(batch), MATCH_MAX_BATCH):
+            chunk = range(start, min(start + MATCH_MAX_BATCH, len(batch)))
+            
+            images = await asyncio.gather(
+                *[download_image_from_url(batch[i].image_url) for i in chunk]
+            )
+            downloaded = [
+                (i, image_data) for i, image_data in zip(chunk, images)
+                if image_data and sniff_image_format(image_data) is not None
+            ]
+            
+            encodings = await run_in_threadpool(
+                get_face_encodings_batch, [image_data for _, image_data in downloaded]
+            )
+            enrolled.extend(
+                (i, encoding) for (i, _), encoding in zip(downloaded, encodings) if encoding is not None
+            )
+        
+        enrolled_indices = {i for i, _ in enrolled}
+        failed_student_ids = [item.student_id for i, item in enumerate(batch) if i not in enrolled_indices]
+        
+        if enrolled:
+            # Store in database
+            await run_in_threadpool(insert_embeddings, [
+                {
+                    'student_id': batch[i].student_id,
+                    'model_name': batch[i].model_name,
+                    'vector_bin': encode_vector(encoding)
+                }
+                for i, encoding in enrolled
+            ])
+            
+            # Update cache
+            await run_in_threadpool(
+                cache_add_encodings,
+                [batch[i].student_id for i, _ in enrolled],
+                [encoding for _, encoding in enrolled]
+            )
+            schedule_ann_refresh()
+        
+        logger.info(f"Created {len(enrolled)} embeddings in batch, {len(failed_student_ids)} failed")
+        
+        return BatchEmbeddingResponse(
+            success=bool(enrolled),
+            created=len(enrolled),
+            failed_student_ids=failed_student_ids,
+            message=f"Created {len(enrolled)} of {len(batch)} embeddings"
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating embeddings in batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.delete("/embeddings/{student_id}")
 async def delete_embedding(student_id: str):
     """Delete embeddings for a student"""
     try:
-        with engine.connect() as conn:
-            conn.execute(text("""
-                DELETE FROM embeddings 
-                WHERE student_id = :student_id
-            """), {'student_id': student_id})
-            
+        await run_in_threadpool(delete_embeddings_from_db, student_id)
+        
         # Update cache
-        if student_id in known_encodings:
-            del known_encodings[student_id]
-        if student_id in known_student_ids:
-            known_student_ids.remove(student_id)
+        await run_in_threadpool(cache_remove_encoding, student_id)
+        schedule_ann_refresh()
         
         logger.info(f"Deleted embeddings for student {student_id}")
         
@@ -315,8 +1091,8 @@ async def delete_embedding(student_id: str):
 async def reload_embeddings():
     """Reload embeddings from database"""
     try:
-        load_embeddings_from_db()
-        return {"success": True, "message": f"Reloaded {len(known_encodings)} embeddings"}
+        await run_in_threadpool(load_embeddings_from_db)
+        return {"success": True, "message": f"Reloaded {len(cache_state.ids)} embeddings"}
     except Exception as e:
         logger.error(f"Error reloading embeddings: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -324,9 +1100,11 @@ async def reload_embeddings():
 @app.get("/embeddings/count")
 async def get_embedding_count():
     """Get count of stored embeddings"""
+    await ensure_cache_current()
+    state = cache_state
     return {
-        "count": len(known_encodings),
-        "student_ids": known_student_ids
+        "count": len(state.ids),
+        "student_ids": list(state.ids)
     }
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+"""Accuracy of the FP16 HNSW index against exact float32 distances"""
+import numpy as np
+
+import main
+
+
+def test_fp16_index_distances_match_float32():
+    rng = np.random.default_rng(0)
+    # dlib encodings are 128-d with components well inside [-0.5, 0.5]
+    matrix = rng.uniform(-0.3, 0.3, (6000, main.ENCODING_DIM)).astype(np.float32)
+    queries = matrix[:200] + rng.normal(0, 0.02, (200, main.ENCODING_DIM)).astype(np.float32)
+    
+    index = main.build_ann_index(matrix)
+    distances, indices = index.search(queries, 1)
+    
+    # Each query is a perturbed enrollment, so that row is its nearest neighbour
+    np.testing.assert_array_equal(indices[:, 0], np.arange(200))
+    
+    exact = np.sqrt(((matrix[:200] - queries) ** 2).sum(axis=1))
+    np.testing.assert_allclose(np.sqrt(distances[:, 0]), exact, atol=1e-3)
@@ -0,0 +1,24 @@
+"""Rejecting non-image uploads before decode and face detection"""
+import cv2
+import numpy as np
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("extension, expected", [(".jpg", "jpeg"), (".png", "png"), (".webp", "webp")])
+def test_sniff_recognises_supported_formats(extension, expected):
+    _, encoded = cv2.imencode(extension, np.zeros((16, 16, 3), dtype=np.uint8))
+    
+    assert main.sniff_image_format(encoded.tobytes()) == expected
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"garbage",
+    b"GIF89a\x01\x00\x01\x00",
+    b"RIFF\x24\x00\x00\x00WAVEfmt ",
+    b"\xff\xd8",
+])
+def test_sniff_rejects_other_data(data):
+    assert main.sniff_image_format(data) is None
@@ -0,0 +1,27 @@
+"""Exact nearest-neighbour kernel used by /match below the ANN threshold"""
+import numpy as np
+
+import main
+
+
+def test_nearest_l2_matches_numpy_argmin():
+    rng = np.random.default_rng(0)
+    matrix = rng.uniform(-0.3, 0.3, (1000, main.ENCODING_DIM)).astype(np.float32)
+    norms_sq = main.row_norms_sq(matrix)
+    
+    for query in rng.uniform(-0.3, 0.3, (20, main.ENCODING_DIM)).astype(np.float32):
+        distances_sq = ((matrix - query) ** 2).sum(axis=1)
+        
+        index, score = main.nearest_l2(matrix, norms_sq, query)
+        
+        assert index == int(np.argmin(distances_sq))
+        # The kernel drops the constant ||q||^2 term from its score
+        np.testing.assert_allclose(score + query @ query, distances_sq.min(), atol=1e-4)
+
+
+def test_nearest_l2_single_row():
+    matrix = np.ones((1, main.ENCODING_DIM), dtype=np.float32)
+    
+    index, _ = main.nearest_l2(matrix, main.row_norms_sq(matrix), np.zeros(main.ENCODING_DIM, dtype=np.float32))
+    
+    assert index == 0
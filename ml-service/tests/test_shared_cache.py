@@ -0,0 +1,149 @@
+"""Shared-memory embedding cache used when running several uvicorn workers"""
+import os
+import struct
+import uuid
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+import main
+
+
+def make_state(student_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = rng.uniform(-0.3, 0.3, (len(student_ids), main.ENCODING_DIM)).astype(np.float32)
+    return main.EncodingCache(matrix, main.row_norms_sq(matrix), tuple(student_ids))
+
+
+def unlink(name):
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.unlink()
+    shm.close()
+
+
+def publish_elsewhere(state):
+    """Publish as another worker would, leaving this worker on its old snapshot"""
+    previous = main.cache_state
+    with main.cache_write_lock():
+        main.publish_cache(state)
+    version = main.cache_state.version
+    main.cache_state = previous
+    return version
+
+
+@pytest.fixture(autouse=True)
+def shared_cache(monkeypatch, tmp_path):
+    prefix = f"labface_test_{uuid.uuid4().hex[:8]}"
+    monkeypatch.setattr(main, "SHARED_CACHE", True)
+    monkeypatch.setattr(main, "SHM_PREFIX", prefix)
+    monkeypatch.setattr(main, "SHM_LOCK_PATH", str(tmp_path / "cache.lock"))
+    monkeypatch.setattr(main, "cache_state", main.EMPTY_CACHE)
+    monkeypatch.setattr(main, "attached_segments", {})
+    monkeypatch.setattr(main, "control_segment", None)
+    main.open_control_segment()
+    
+    yield
+    
+    main.cache_state = main.EMPTY_CACHE
+    for version, shm in list(main.attached_segments.items()):
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        main.unlink_segment(version)
+    main.control_segment.close()
+    unlink(f"{prefix}_ctl")
+
+
+def test_segment_round_trip():
+    state = make_state(["s1", "s2", "s3"])
+    shm = main.write_segment(7, state)
+    main.attached_segments[7] = shm
+    
+    snapshot = main.view_segment(7, shm)
+    
+    assert snapshot.version == 7
+    assert snapshot.ids == ("s1", "s2", "s3")
+    np.testing.assert_array_equal(snapshot.matrix, state.matrix)
+    np.testing.assert_array_equal(snapshot.norms_sq, state.norms_sq)
+
+
+def test_publish_bumps_version_and_unlinks_previous_segment():
+    with main.cache_write_lock():
+        main.publish_cache(make_state(["s1"]))
+    assert main.read_shared_version() == 1
+    
+    with main.cache_write_lock():
+        main.publish_cache(make_state(["s1", "s2"]))
+    
+    assert main.read_shared_version() == 2
+    assert main.cache_state.version == 2
+    assert main.cache_state.ids == ("s1", "s2")
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=main.segment_name(1))
+
+
+def test_release_stale_segments_waits_for_live_snapshots():
+    with main.cache_write_lock():
+        main.publish_cache(make_state(["s1"]))
+    held = main.cache_state  # an in-flight /match still scanning version 1
+    
+    with main.cache_write_lock():
+        main.publish_cache(make_state(["s1", "s2"]))
+    
+    assert 1 in main.attached_segments
+    assert held.matrix.shape == (1, main.ENCODING_DIM)
+    
+    del held
+    main.release_stale_segments()
+    
+    assert sorted(main.attached_segments) == [2]
+
+
+def test_version_from_another_server_is_ignored():
+    struct.pack_into("qq", main.control_segment.buf, 0, 5, os.getppid() + 1)
+    assert main.read_shared_version() == 0
+    
+    struct.pack_into("qq", main.control_segment.buf, 0, 5, os.getppid())
+    assert main.read_shared_version() == 5
+
+
+def test_rebind_picks_up_another_workers_snapshot():
+    version = publish_elsewhere(make_state(["s1", "s2"]))
+    
+    assert main.cache_state.version == 0
+    assert main.sync_shared_cache()
+    assert main.cache_state.version == version
+    assert main.cache_state.ids == ("s1", "s2")
+
+
+def test_rebind_extends_index_when_rows_were_appended():
+    ids = [f"s{i}" for i in range(200)]
+    with main.cache_write_lock():
+        main.publish_cache(make_state(ids))
+    main.cache_state = main.cache_state._replace(ann_index=main.build_ann_index(main.cache_state.matrix))
+    
+    # Same seed, so the first 200 rows are unchanged and one row is appended
+    publish_elsewhere(make_state(ids + ["new"]))
+    
+    assert main.sync_shared_cache()
+    assert main.cache_state.ann_index is not None
+    assert main.cache_state.ann_index.ntotal == 201
+    _, indices = main.cache_state.ann_index.search(main.cache_state.matrix[-1:], 1)
+    assert main.cache_state.ids[indices[0, 0]] == "new"
+
+
+def test_rebind_drops_index_when_rows_were_replaced():
+    ids = [f"s{i}" for i in range(200)]
+    with main.cache_write_lock():
+        main.publish_cache(make_state(ids))
+    main.cache_state = main.cache_state._replace(ann_index=main.build_ann_index(main.cache_state.matrix))
+    
+    publish_elsewhere(make_state(ids, seed=1))
+    
+    assert main.sync_shared_cache()
+    assert main.cache_state.ann_index is None
@@ -0,0 +1,33 @@
+"""Storage format of face encodings in the embeddings table"""
+import numpy as np
+import orjson
+
+import main
+
+
+def test_encode_decode_round_trip():
+    encoding = np.random.default_rng(0).uniform(-0.3, 0.3, main.ENCODING_DIM)
+    
+    stored = main.encode_vector(encoding)
+    decoded = main.decode_vector(stored)
+    
+    assert len(stored) == main.ENCODING_DIM * 4
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, encoding.astype(np.float32))
+
+
+def test_decode_falls_back_to_legacy_json():
+    encoding = np.random.default_rng(0).uniform(-0.3, 0.3, main.ENCODING_DIM)
+    
+    decoded = main.decode_vector(None, orjson.dumps(encoding.tolist()).decode())
+    
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, encoding.astype(np.float32))
+
+
+def test_binary_column_wins_over_json():
+    encoding = np.ones(main.ENCODING_DIM, dtype=np.float32)
+    
+    decoded = main.decode_vector(main.encode_vector(encoding), orjson.dumps([0.0] * main.ENCODING_DIM).decode())
+    
+    np.testing.assert_array_equal(decoded, encoding)